@@ -115,7 +115,7 @@ class BaseOS(object):
                      interface, e, e.output)
 
     @classmethod
-    def bring_interfaces_up(cls, ip, primary_interface):
+    def bring_interfaces_up(cls, ip_version, primary_interface):
         cls._bring_if_down(primary_interface)
         cls._bring_if_up(primary_interface, 'VIP')
 
@@ -13,14 +13,17 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import ipaddress
 import os
+import re
 import socket
 import stat
 import subprocess
+import threading
+import time
 
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
 import pyroute2
 import webob
 from werkzeug import exceptions
@@ -32,10 +35,118 @@ CONF = cfg.CONF
 
 LOG = logging.getLogger(__name__)
 
+# Minimum number of seconds between two rescans of the PCI bus
+PCI_RESCAN_INTERVAL = 2
+# The rescan file does not come and go at runtime, check for it only once
+_PCI_RESCAN_PATH = ('/sys/bus/pci/rescan'
+                    if os.path.isfile('/sys/bus/pci/rescan') else None)
+
+# Commands run in the amphora network namespace when the VIP is plugged.
+# For lvs function, enable ip_vs kernel module, enable ip_forward
+# conntrack in amphora network namespace.
+_NS_CMDS = ((consts.SYSCTL_CMD, '--system'),
+            ('modprobe', 'ip_vs'),
+            (consts.SYSCTL_CMD, '-w', 'net.ipv4.vs.conntrack=1'))
+_V4_NS_CMDS = _NS_CMDS + (
+    (consts.SYSCTL_CMD, '-w', 'net.ipv4.ip_forward=1'),)
+_V6_NS_CMDS = _NS_CMDS + (
+    (consts.SYSCTL_CMD, '-w', 'net.ipv6.conf.all.forwarding=1'),)
+# The commands are run from a single shell, they are independent so a
+# failure must not stop the others.
+_V4_NS_SCRIPT = '; '.join(' '.join(cmd) for cmd in _V4_NS_CMDS)
+_V6_NS_SCRIPT = '; '.join(' '.join(cmd) for cmd in _V6_NS_CMDS)
+
+_PLUG_FILE_READ_FLAGS = os.O_RDONLY | os.O_CREAT
+_PLUG_FILE_APPEND_FLAGS = os.O_WRONLY | os.O_APPEND
+# mode 0644
+_PLUG_FILE_MODE = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
+
+# The error responses have constant bodies, serialize them only once
+_INVALID_VIP_BODY = jsonutils.dump_as_bytes(dict(message="Invalid VIP"))
+_INVALID_PORT_BODY = jsonutils.dump_as_bytes(
+    dict(message="Invalid network port"))
+_INTERFACE_EXISTS_BODY = jsonutils.dump_as_bytes(
+    dict(message="Interface already exists"))
+_NO_INTERFACE_BODY = jsonutils.dump_as_bytes(
+    dict(details="No suitable network interface found"))
+
+
+def _json_response(body, status):
+    return webob.Response(body=body, content_type='application/json',
+                          status=status)
+
+
+def _subnet_prefixlen(subnet_cidr):
+    """Return the prefix length of a subnet in CIDR notation.
+
+    Raises socket.error or ValueError if subnet_cidr is not a valid network
+    address. Unlike ipaddress.ip_network, the prefix must be a length, not
+    a netmask.
+    """
+    if not isinstance(subnet_cidr, str):
+        raise ValueError(f"Invalid subnet: {subnet_cidr!r}")
+    address, sep, prefix = subnet_cidr.partition('/')
+    try:
+        packed = socket.inet_pton(socket.AF_INET, address)
+    except socket.error:
+        packed = socket.inet_pton(socket.AF_INET6, address)
+    max_prefixlen = len(packed) * 8
+    if not sep:
+        return max_prefixlen
+    if not re.fullmatch(r'[0-9]+', prefix):
+        raise ValueError(f"Invalid prefix length: {prefix}")
+    prefixlen = int(prefix)
+    if prefixlen > max_prefixlen:
+        raise ValueError(f"Invalid prefix length: {prefix}")
+    # Host bits must not be set
+    if int.from_bytes(packed, 'big') & ((1 << max_prefixlen - prefixlen) - 1):
+        raise ValueError(f"{subnet_cidr} has host bits set")
+    return prefixlen
+
 
 class Plug(object):
     def __init__(self, osutils):
         self._osutils = osutils
+        # Netlink handles are opened on first use, so they are created in
+        # the gunicorn worker and not in the preloading master process.
+        self._ipr = None
+        self._netns_cache = {}
+        self._last_pci_rescan = None
+        self._plug_lock = threading.Lock()
+        # Reentrant, the handles are also opened while plugging
+        self._netns_lock = threading.RLock()
+
+    def _get_ipr(self):
+        if self._ipr is None:
+            with self._netns_lock:
+                if self._ipr is None:
+                    self._ipr = pyroute2.IPRoute()
+        return self._ipr
+
+    def _get_netns(self, namespace=consts.AMPHORA_NAMESPACE):
+        netns = self._netns_cache.get(namespace)
+        if netns is None:
+            with self._netns_lock:
+                netns = self._netns_cache.get(namespace)
+                if netns is None:
+                    try:
+                        pyroute2.netns.create(namespace)
+                    except FileExistsError:
+                        pass
+                    # NetNS defaults to O_CREAT, the namespace already
+                    # exists
+                    netns = pyroute2.NetNS(namespace, flags=0)
+                    self._netns_cache[namespace] = netns
+        return netns
+
+    def close(self):
+        with self._netns_lock:
+            if self._ipr is not None:
+                self._ipr.close()
+                self._ipr = None
+            for netns in self._netns_cache.values():
+                netns.close()
+            self._netns_cache.clear()
 
     def plug_lo(self):
         self._osutils.write_interface_file(
@@ -45,84 +156,83 @@ class Plug(object):
 
     def plug_vip(self, vip, subnet_cidr, gateway,
                  mac_address, mtu=None, vrrp_ip=None, host_routes=None):
-        # Validate vip and subnet_cidr, calculate broadcast address and netmask
+        if not isinstance(mac_address, str):
+            return _json_response(_INVALID_VIP_BODY, 400)
+        # The kernel reports MAC addresses in lower case
+        mac_address = mac_address.lower()
+
+        # Validate vip and subnet_cidr, get the prefix length of the subnet
         try:
-            ip = ipaddress.ip_address(vip)
-            network = ipaddress.ip_network(subnet_cidr)
-            vip = ip.exploded
-            prefixlen = network.prefixlen
-        except ValueError:
-            return webob.Response(json=dict(message="Invalid VIP"),
-                                  status=400)
-
-        # Check if the interface is already in the network namespace
-        # Do not attempt to re-plug the VIP if it is already in the
-        # network namespace
-        if self._netns_interface_exists(mac_address):
-            return webob.Response(
-                json=dict(message="Interface already exists"), status=409)
-
-        # Check that the interface has been fully plugged
-        self._interface_by_mac(mac_address)
-
-        # Always put the VIP interface as eth1
-        primary_interface = consts.NETNS_PRIMARY_INTERFACE
-
-        self._osutils.write_vip_interface_file(
-            interface=primary_interface,
-            vip=vip,
-            ip_version=ip.version,
-            prefixlen=prefixlen,
-            gateway=gateway,
-            mtu=mtu,
-            vrrp_ip=vrrp_ip,
-            host_routes=host_routes)
-
-        # Update the list of interfaces to add to the namespace
-        # This is used in the amphora reboot case to re-establish the namespace
-        self._update_plugged_interfaces_file(primary_interface, mac_address)
-
-        # Create the namespace
-        netns = pyroute2.NetNS(consts.AMPHORA_NAMESPACE, flags=os.O_CREAT)
-        netns.close()
-
-        # Load sysctl in new namespace
-        sysctl = pyroute2.NSPopen(consts.AMPHORA_NAMESPACE,
-                                  [consts.SYSCTL_CMD, '--system'],
-                                  stdout=subprocess.PIPE)
-
-        sysctl.communicate()
-        sysctl.wait()
-        sysctl.release()
-
-        cmd_list = [['modprobe', 'ip_vs'],
-                    [consts.SYSCTL_CMD, '-w', 'net.ipv4.vs.conntrack=1']]
-        if ip.version == 4:
-            # For lvs function, enable ip_vs kernel module, enable ip_forward
-            # conntrack in amphora network namespace.
-            cmd_list.append([consts.SYSCTL_CMD, '-w', 'net.ipv4.ip_forward=1'])
-        elif ip.version == 6:
-            cmd_list.append([consts.SYSCTL_CMD, '-w',
-                             'net.ipv6.conf.all.forwarding=1'])
-        for cmd in cmd_list:
-            ns_exec = pyroute2.NSPopen(consts.AMPHORA_NAMESPACE, cmd,
+            try:
+                packed_vip = socket.inet_pton(socket.AF_INET, vip)
+                ip_version = 4
+                vip = socket.inet_ntop(socket.AF_INET, packed_vip)
+            except socket.error:
+                packed_vip = socket.inet_pton(socket.AF_INET6, vip)
+                ip_version = 6
+                # Use the exploded form of the address
+                vip = ':'.join(packed_vip[i:i + 2].hex()
+                               for i in range(0, 16, 2))
+            prefixlen = _subnet_prefixlen(subnet_cidr)
+        except (socket.error, TypeError, ValueError):
+            return _json_response(_INVALID_VIP_BODY, 400)
+
+        # Check that the interface has been fully plugged, its index is
+        # used to move it into the namespace
+        idx, _ = self._link_by_mac(mac_address)
+
+        # Moving the VIP interface changes the number of links in the
+        # namespace, see plug_network
+        with self._netns_lock:
+            # Check if the interface is already in the network namespace
+            # Do not attempt to re-plug the VIP if it is already in the
+            # network namespace
+            if self._netns_interface_exists(mac_address):
+                return _json_response(_INTERFACE_EXISTS_BODY, 409)
+
+            # Always put the VIP interface as eth1
+            primary_interface = consts.NETNS_PRIMARY_INTERFACE
+
+            # Load sysctl in new namespace
+            # The interface files are written while the shell is running, it
+            # only has to complete before the interface is moved.
+            script = _V4_NS_SCRIPT if ip_version == 4 else _V6_NS_SCRIPT
+            ns_exec = pyroute2.NSPopen(consts.AMPHORA_NAMESPACE,
+                                       ['sh', '-c', script],
                                        stdout=subprocess.PIPE)
-            ns_exec.wait()
-            ns_exec.release()
+            try:
+                self._osutils.write_vip_interface_file(
+                    interface=primary_interface,
+                    vip=vip,
+                    ip_version=ip_version,
+                    prefixlen=prefixlen,
+                    gateway=gateway,
+                    mtu=mtu,
+                    vrrp_ip=vrrp_ip,
+                    host_routes=host_routes)
+
+                # Update the list of interfaces to add to the namespace
+                # This is used in the amphora reboot case to re-establish the
+                # namespace
+                self._update_plugged_interfaces_file(primary_interface,
+                                                     mac_address)
+            finally:
+                ns_exec.communicate()
+                ns_exec.wait()
+                ns_exec.release()
 
-        with pyroute2.IPRoute() as ipr:
             # Move the interfaces into the namespace
-            idx = ipr.link_lookup(address=mac_address)[0]
-            ipr.link('set', index=idx, net_ns_fd=consts.AMPHORA_NAMESPACE,
-                     IFLA_IFNAME=primary_interface)
+            self._get_ipr().link('set', index=idx,
+                                 net_ns_fd=consts.AMPHORA_NAMESPACE,
+                                 IFLA_IFNAME=primary_interface)
 
         # bring interfaces up
-        self._osutils.bring_interfaces_up(ip, primary_interface)
+        self._osutils.bring_interfaces_up(ip_version, primary_interface)
 
         return webob.Response(json=dict(
             message="OK",
-            details="VIP {vip} plugged on interface {interface}".format(
-                vip=vip, interface=primary_interface)), status=202)
+            details=f"VIP {vip} plugged on interface {primary_interface}"),
+            status=202)
 
     def _check_ip_addresses(self, fixed_ips):
         if fixed_ips:
@@ -133,101 +243,130 @@ class Plug(object):
                     socket.inet_pton(socket.AF_INET6, ip.get('ip_address'))
 
     def plug_network(self, mac_address, fixed_ips, mtu=None):
-        # Check if the interface is already in the network namespace
-        # Do not attempt to re-plug the network if it is already in the
-        # network namespace
-        if self._netns_interface_exists(mac_address):
-            return webob.Response(json=dict(
-                message="Interface already exists"), status=409)
-
-        # This is the interface as it was initially plugged into the
-        # default network namespace, this will likely always be eth1
-
         try:
             self._check_ip_addresses(fixed_ips=fixed_ips)
         except socket.error:
-            return webob.Response(json=dict(
-                message="Invalid network port"), status=400)
-
-        default_netns_interface = self._interface_by_mac(mac_address)
+            return _json_response(_INVALID_PORT_BODY, 400)
+        if not isinstance(mac_address, str):
+            return _json_response(_INVALID_PORT_BODY, 400)
+        # The kernel reports MAC addresses in lower case
+        mac_address = mac_address.lower()
 
-        # We need to determine the interface name when inside the namespace
-        # to avoid name conflicts
-        with pyroute2.NetNS(consts.AMPHORA_NAMESPACE,
-                            flags=os.O_CREAT) as netns:
+        # This is the interface as it was initially plugged into the
+        # default network namespace, this will likely always be eth1
+        idx, default_netns_interface = self._link_by_mac(mac_address)
+
+        # The name of the interface in the namespace depends on the number
+        # of links in it, concurrent plugs must not interleave until the
+        # interface is moved into the namespace
+        with self._netns_lock:
+            # Check if the interface is already in the network namespace
+            # Do not attempt to re-plug the network if it is already in the
+            # network namespace
+            # The number of links is also used below to determine the interface
+            # name when inside the namespace to avoid name conflicts
+            interface_exists, link_count = self._netns_link_info(
+                mac_address)
+            if interface_exists:
+                return _json_response(_INTERFACE_EXISTS_BODY, 409)
 
             # 1 means just loopback, but we should already have a VIP. This
             # works for the add/delete/add case as we don't delete interfaces
             # Note, eth0 is skipped because that is the VIP interface
-            netns_interface = 'eth{0}'.format(len(netns.get_links()))
+            netns_interface = f'eth{link_count}'
 
-        LOG.info('Plugged interface %s will become %s in the namespace %s',
-                 default_netns_interface, netns_interface,
-                 consts.AMPHORA_NAMESPACE)
-        self._osutils.write_port_interface_file(
-            interface=netns_interface,
-            fixed_ips=fixed_ips,
-            mtu=mtu)
+            LOG.info('Plugged interface %s will become %s in the namespace %s',
+                     default_netns_interface, netns_interface,
+                     consts.AMPHORA_NAMESPACE)
+            self._osutils.write_port_interface_file(
+                interface=netns_interface,
+                fixed_ips=fixed_ips,
+                mtu=mtu)
 
-        # Update the list of interfaces to add to the namespace
-        self._update_plugged_interfaces_file(netns_interface, mac_address)
+            # Update the list of interfaces to add to the namespace
+            self._update_plugged_interfaces_file(netns_interface, mac_address)
 
-        with pyroute2.IPRoute() as ipr:
             # Move the interfaces into the namespace
-            idx = ipr.link_lookup(address=mac_address)[0]
-            ipr.link('set', index=idx,
-                     net_ns_fd=consts.AMPHORA_NAMESPACE,
-                     IFLA_IFNAME=netns_interface)
+            self._get_ipr().link('set', index=idx,
+                                 net_ns_fd=consts.AMPHORA_NAMESPACE,
+                                 IFLA_IFNAME=netns_interface)
 
         self._osutils._bring_if_down(netns_interface)
         self._osutils._bring_if_up(netns_interface, 'network')
 
         return webob.Response(json=dict(
             message="OK",
-            details="Plugged on interface {interface}".format(
-                interface=netns_interface)), status=202)
+            details=f"Plugged on interface {netns_interface}"), status=202)
 
-    def _interface_by_mac(self, mac):
+    def _link_by_mac(self, mac):
+        # A single dump of the links gives both the index and the name of
+        # the interface
         try:
-            with pyroute2.IPRoute() as ipr:
-                idx = ipr.link_lookup(address=mac)[0]
-                addr = ipr.get_links(idx)[0]
-                for attr in addr['attrs']:
-                    if attr[0] == 'IFLA_IFNAME':
-                        return attr[1]
+            for link in self._get_ipr().get_links():
+                if link.get_attr('IFLA_ADDRESS') == mac:
+                    return link['index'], link.get_attr('IFLA_IFNAME')
+            error = 'no link with this address'
         except Exception as e:
-            LOG.info('Unable to find interface with MAC: %s, rescanning '
-                     'and returning 404. Reported error: %s', mac, str(e))
-
+            error = str(e)
+        # The interface is not in the default namespace anymore once it
+        # has been plugged
+        if self._netns_interface_exists(mac):
+            raise exceptions.HTTPException(
+                response=_json_response(_INTERFACE_EXISTS_BODY, 409))
+        LOG.info('Unable to find interface with MAC: %s, rescanning '
+                 'and returning 404. Reported error: %s', mac, error)
+        self._interface_not_found()
+
+    def _interface_not_found(self):
         # Poke the kernel to re-enumerate the PCI bus.
         # We have had cases where nova hot plugs the interface but
         # the kernel doesn't get the memo.
-        filename = '/sys/bus/pci/rescan'
-        flags = os.O_WRONLY
-        if os.path.isfile(filename):
-            with os.fdopen(os.open(filename, flags), 'w') as rescan_file:
-                rescan_file.write('1')
+        # The controller retries the plug requests, so the rescans are
+        # rate limited to avoid queuing them up in the kernel.
+        now = time.monotonic()
+        if (self._last_pci_rescan is None or
+                now - self._last_pci_rescan >= PCI_RESCAN_INTERVAL):
+            self._last_pci_rescan = now
+            if _PCI_RESCAN_PATH is not None:
+                with os.fdopen(os.open(_PCI_RESCAN_PATH, os.O_WRONLY),
+                               'w') as rescan_file:
+                    rescan_file.write('1')
         raise exceptions.HTTPException(
-            response=webob.Response(json=dict(
-                details="No suitable network interface found"), status=404))
+            response=_json_response(_NO_INTERFACE_BODY, 404))
 
     def _update_plugged_interfaces_file(self, interface, mac_address):
         # write interfaces to plugged_interfaces file and prevent duplicates
-        plug_inf_file = consts.PLUGGED_INTERFACES
-        flags = os.O_RDWR | os.O_CREAT
-        # mode 0644
-        mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-        with os.fdopen(os.open(plug_inf_file, flags, mode), 'r+') as text_file:
-            inf_list = [inf.split()[0].rstrip() for inf in text_file]
-            if mac_address not in inf_list:
-                text_file.write("{mac_address} {interface}\n".format(
-                    mac_address=mac_address, interface=interface))
+        with self._plug_lock:
+            fd = os.open(consts.PLUGGED_INTERFACES, _PLUG_FILE_READ_FLAGS,
+                         _PLUG_FILE_MODE)
+            try:
+                chunks = []
+                while True:
+                    chunk = os.read(fd, 4096)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                os.close(fd)
+            content = b''.join(chunks)
+            pattern = (rb'^\s*' + re.escape(mac_address.encode()) +
+                       rb'(?:\s|$)')
+            if re.search(pattern, content, re.MULTILINE):
+                return
+            # O_APPEND writes the whole line at the end of the file at once
+            fd = os.open(consts.PLUGGED_INTERFACES, _PLUG_FILE_APPEND_FLAGS)
+            try:
+                os.write(fd, f"{mac_address} {interface}\n".encode())
+            finally:
+                os.close(fd)
+
+    def _netns_link_info(self, mac_address):
+        links = self._get_netns().get_links()
+        for link in links:
+            if link.get_attr('IFLA_ADDRESS') == mac_address:
+                return True, len(links)
+        return False, len(links)
 
     def _netns_interface_exists(self, mac_address):
-        with pyroute2.NetNS(consts.AMPHORA_NAMESPACE,
-                            flags=os.O_CREAT) as netns:
-            for link in netns.get_links():
-                for attr in link['attrs']:
-                    if attr[0] == 'IFLA_ADDRESS' and attr[1] == mac_address:
-                        return True
-        return False
+        netns = self._get_netns()
+        return bool(netns.link_lookup(address=mac_address))
@@ -138,6 +138,9 @@ class Server(object):
                               view_func=self.get_interface,
                               methods=['GET'])
 
+    def shutdown(self):
+        self._plug.close()
+
     def upload_haproxy_config(self, amphora_id, lb_id):
         return self._loadbalancer.upload_haproxy_config(amphora_id, lb_id)
 
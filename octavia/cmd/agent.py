@@ -84,6 +84,6 @@ def main():
         'syslog_facility': 'local{}'.format(
             CONF.amphora_agent.administrative_log_facility),
         'syslog_addr': 'unix://run/rsyslog/octavia/log#dgram',
-
+        'worker_exit': lambda arbiter, worker: server_instance.shutdown(),
     }
     AmphoraAgent(server_instance.app, options).run()
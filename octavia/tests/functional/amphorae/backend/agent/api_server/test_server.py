@@ -27,6 +27,7 @@ from oslo_utils import uuidutils
 
 from octavia.amphorae.backends.agent import api_server
 from octavia.amphorae.backends.agent.api_server import certificate_update
+from octavia.amphorae.backends.agent.api_server import plug
 from octavia.amphorae.backends.agent.api_server import server
 from octavia.amphorae.backends.agent.api_server import util
 from octavia.common import config
@@ -42,6 +43,14 @@ OK = dict(message='OK')
 FAKE_INTERFACE = 'eth33'
 
 
+def _fake_link(index=33, ifname=FAKE_INTERFACE, address='123'):
+    link = mock.MagicMock()
+    link.__getitem__.side_effect = {'index': index}.__getitem__
+    link.get_attr.side_effect = {
+        'IFLA_IFNAME': ifname, 'IFLA_ADDRESS': address}.get
+    return link
+
+
 class TestServerTestCase(base.TestCase):
     app = None
 
@@ -961,38 +970,33 @@ class TestServerTestCase(base.TestCase):
     def test_centos_plug_network(self):
         self._test_plug_network(consts.CENTOS)
 
+    @mock.patch('time.monotonic')
+    @mock.patch('octavia.amphorae.backends.agent.api_server.'
+                'plug.Plug._update_plugged_interfaces_file')
     @mock.patch('os.chmod')
     @mock.patch('pyroute2.IPRoute', create=True)
+    @mock.patch('pyroute2.netns.create', create=True)
     @mock.patch('pyroute2.NetNS', create=True)
     @mock.patch('subprocess.check_output')
     @mock.patch('octavia.amphorae.backends.agent.api_server.'
-                'plug.Plug._netns_interface_exists')
-    @mock.patch('os.path.isfile')
-    def _test_plug_network(self, distro, mock_isfile, mock_int_exists,
-                           mock_check_output, mock_netns, mock_pyroute2,
-                           mock_os_chmod):
-        mock_ipr = mock.MagicMock()
+                'plug.Plug._netns_link_info')
+    @mock.patch('octavia.amphorae.backends.agent.api_server.plug.'
+                '_PCI_RESCAN_PATH', '/sys/bus/pci/rescan')
+    def _test_plug_network(self, distro, mock_link_info,
+                           mock_check_output, mock_netns, mock_netns_create,
+                           mock_pyroute2, mock_os_chmod, mock_update_plugged,
+                           mock_time):
         mock_ipr_instance = mock.MagicMock()
-        mock_ipr_instance.link_lookup.side_effect = [
-            [], [], [33], [33], [33], [33], [33], [33], [33], [33]]
-        mock_ipr_instance.get_links.return_value = ({
-            'attrs': [('IFLA_IFNAME', FAKE_INTERFACE)]},)
-        mock_ipr.__enter__.return_value = mock_ipr_instance
-        mock_pyroute2.return_value = mock_ipr
+        mock_ipr_instance.get_links.return_value = [_fake_link()]
+        mock_pyroute2.return_value = mock_ipr_instance
+        mock_netns.return_value.link_lookup.return_value = []
 
         self.assertIn(distro, [consts.UBUNTU, consts.CENTOS])
         port_info = {'mac_address': '123'}
         test_int_num = random.randint(0, 9999)
 
-        mock_int_exists.return_value = False
-        netns_handle = mock_netns.return_value.__enter__.return_value
-        netns_handle.get_links.return_value = [0] * test_int_num
-        mock_isfile.return_value = True
-
-        test_int_num = str(test_int_num)
-
         # Interface already plugged
-        mock_int_exists.return_value = True
+        mock_link_info.return_value = (True, test_int_num)
         if distro == consts.UBUNTU:
             rv = self.ubuntu_app.post('/' + api_server.VERSION +
                                       "/plug/network",
@@ -1006,9 +1010,13 @@ class TestServerTestCase(base.TestCase):
         self.assertEqual(409, rv.status_code)
         self.assertEqual(dict(message="Interface already exists"),
                          jsonutils.loads(rv.data.decode('utf-8')))
-        mock_int_exists.return_value = False
+        mock_link_info.return_value = (False, test_int_num)
+
+        test_int_num = str(test_int_num)
 
         # No interface at all
+        mock_ipr_instance.get_links.return_value = []
+        mock_time.return_value = 100
         file_name = '/sys/bus/pci/rescan'
         m = self.useFixture(test_utils.OpenFixture(file_name)).mock_open
         with mock.patch('os.open') as mock_open, mock.patch.object(
@@ -1032,12 +1040,38 @@ class TestServerTestCase(base.TestCase):
                          jsonutils.loads(rv.data.decode('utf-8')))
 
         # No interface down
+        # The PCI bus was rescanned within PCI_RESCAN_INTERVAL, it is not
+        # rescanned again
+        mock_time.return_value = 100 + plug.PCI_RESCAN_INTERVAL - 1
         m().reset_mock()
         with mock.patch('os.open') as mock_open, mock.patch.object(
-                os, 'fdopen', m) as mock_fdopen, mock.patch(
+                os, 'fdopen', m), mock.patch(
                     'octavia.amphorae.backends.utils.interface_file.'
                     'InterfaceFile.dump') as mock_dump:
             mock_open.return_value = 123
+            if distro == consts.UBUNTU:
+                rv = self.ubuntu_app.post('/' + api_server.VERSION +
+                                          "/plug/network",
+                                          content_type='application/json',
+                                          data=jsonutils.dumps(port_info))
+            elif distro == consts.CENTOS:
+                rv = self.centos_app.post('/' + api_server.VERSION +
+                                          "/plug/network",
+                                          content_type='application/json',
+                                          data=jsonutils.dumps(port_info))
+            mock_open.assert_not_called()
+        m().write.assert_not_called()
+        self.assertEqual(404, rv.status_code)
+        self.assertEqual(dict(details="No suitable network interface found"),
+                         jsonutils.loads(rv.data.decode('utf-8')))
+
+        # Still no interface, PCI_RESCAN_INTERVAL has elapsed since the last
+        # rescan, the PCI bus is rescanned again
+        mock_time.return_value = 100 + plug.PCI_RESCAN_INTERVAL
+        m().reset_mock()
+        with mock.patch('os.open') as mock_open, mock.patch.object(
+                os, 'fdopen', m) as mock_fdopen:
+            mock_open.return_value = 123
             if distro == consts.UBUNTU:
                 rv = self.ubuntu_app.post('/' + api_server.VERSION +
                                           "/plug/network",
@@ -1056,6 +1090,7 @@ class TestServerTestCase(base.TestCase):
                          jsonutils.loads(rv.data.decode('utf-8')))
 
         # One Interface down, Happy Path
+        mock_ipr_instance.get_links.return_value = [_fake_link()]
         mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
 
         if self.conf.conf.amphora_agent.agent_server_network_file:
@@ -1088,11 +1123,8 @@ class TestServerTestCase(base.TestCase):
             mock_open.assert_any_call(file_name, flags, mode)
             mock_fdopen.assert_any_call(123, 'w')
 
-            plug_inf_file = '/var/lib/octavia/plugged_interfaces'
-            flags = os.O_RDWR | os.O_CREAT
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            mock_open.assert_any_call(plug_inf_file, flags, mode)
-            mock_fdopen.assert_any_call(123, 'r+')
+            mock_update_plugged.assert_called_with(
+                'eth' + test_int_num, '123')
 
             expected_dict = {
                 consts.NAME: "eth{}".format(test_int_num),
@@ -1172,11 +1204,8 @@ class TestServerTestCase(base.TestCase):
             mock_open.assert_any_call(file_name, flags, mode)
             mock_fdopen.assert_any_call(123, 'w')
 
-            plug_inf_file = '/var/lib/octavia/plugged_interfaces'
-            flags = os.O_RDWR | os.O_CREAT
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            mock_open.assert_any_call(plug_inf_file, flags, mode)
-            mock_fdopen.assert_any_call(123, 'r+')
+            mock_update_plugged.assert_called_with(
+                'eth' + test_int_num, '123')
 
             expected_dict = {
                 consts.NAME: "eth{}".format(test_int_num),
@@ -1242,11 +1271,8 @@ class TestServerTestCase(base.TestCase):
             mock_open.assert_any_call(file_name, flags, mode)
             mock_fdopen.assert_any_call(123, 'w')
 
-            plug_inf_file = '/var/lib/octavia/plugged_interfaces'
-            flags = os.O_RDWR | os.O_CREAT
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            mock_open.assert_any_call(plug_inf_file, flags, mode)
-            mock_fdopen.assert_any_call(123, 'r+')
+            mock_update_plugged.assert_called_with(
+                'eth' + test_int_num, '123')
 
             expected_dict = {
                 consts.NAME: "eth{}".format(test_int_num),
@@ -1362,20 +1388,20 @@ class TestServerTestCase(base.TestCase):
     def test_centos_plug_network_host_routes(self):
         self._test_plug_network_host_routes(consts.CENTOS)
 
+    @mock.patch('octavia.amphorae.backends.agent.api_server.'
+                'plug.Plug._update_plugged_interfaces_file')
     @mock.patch('os.chmod')
     @mock.patch('pyroute2.IPRoute', create=True)
+    @mock.patch('pyroute2.netns.create', create=True)
     @mock.patch('pyroute2.NetNS', create=True)
     @mock.patch('subprocess.check_output')
     def _test_plug_network_host_routes(self, distro, mock_check_output,
-                                       mock_netns, mock_pyroute2,
-                                       mock_os_chmod):
-        mock_ipr = mock.MagicMock()
+                                       mock_netns, mock_netns_create,
+                                       mock_pyroute2, mock_os_chmod,
+                                       mock_update_plugged):
         mock_ipr_instance = mock.MagicMock()
-        mock_ipr_instance.link_lookup.return_value = [33]
-        mock_ipr_instance.get_links.return_value = ({
-            'attrs': [('IFLA_IFNAME', FAKE_INTERFACE)]},)
-        mock_ipr.__enter__.return_value = mock_ipr_instance
-        mock_pyroute2.return_value = mock_ipr
+        mock_ipr_instance.get_links.return_value = [_fake_link()]
+        mock_pyroute2.return_value = mock_ipr_instance
 
         self.assertIn(distro, [consts.UBUNTU, consts.CENTOS])
 
@@ -1387,9 +1413,10 @@ class TestServerTestCase(base.TestCase):
         DEST2 = '203.0.113.1/32'
         NEXTHOP = '192.0.2.1'
 
-        netns_handle = mock_netns.return_value.__enter__.return_value
-        netns_handle.get_links.return_value = [{
-            'attrs': [['IFLA_IFNAME', consts.NETNS_PRIMARY_INTERFACE]]}]
+        netns_handle = mock_netns.return_value
+        mock_netns_link = mock.MagicMock()
+        mock_netns_link.get_attr.return_value = consts.NETNS_PRIMARY_INTERFACE
+        netns_handle.get_links.return_value = [mock_netns_link]
 
         port_info = {'mac_address': MAC, 'mtu': 1450, 'fixed_ips': [
             {'ip_address': IP, 'subnet_cidr': SUBNET_CIDR,
@@ -1422,11 +1449,8 @@ class TestServerTestCase(base.TestCase):
             mock_open.assert_any_call(file_name, flags, mode)
             mock_fdopen.assert_any_call(123, 'w')
 
-            plug_inf_file = '/var/lib/octavia/plugged_interfaces'
-            flags = os.O_RDWR | os.O_CREAT
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            mock_open.assert_any_call(plug_inf_file, flags, mode)
-            mock_fdopen.assert_any_call(123, 'r+')
+            mock_update_plugged.assert_called_with(
+                consts.NETNS_PRIMARY_INTERFACE, MAC)
 
             expected_dict = {
                 consts.NAME: consts.NETNS_PRIMARY_INTERFACE,
@@ -1477,6 +1501,9 @@ class TestServerTestCase(base.TestCase):
 
         self._test_plug_VIP4(consts.CENTOS)
 
+    @mock.patch('time.monotonic')
+    @mock.patch('octavia.amphorae.backends.agent.api_server.'
+                'plug.Plug._update_plugged_interfaces_file')
     @mock.patch('os.chmod')
     @mock.patch('shutil.copy2')
     @mock.patch('pyroute2.NSPopen', create=True)
@@ -1488,21 +1515,16 @@ class TestServerTestCase(base.TestCase):
     @mock.patch('subprocess.check_output')
     @mock.patch('shutil.copytree')
     @mock.patch('os.makedirs')
-    @mock.patch('os.path.isfile')
-    def _test_plug_VIP4(self, distro, mock_isfile, mock_makedirs,
+    @mock.patch('octavia.amphorae.backends.agent.api_server.plug.'
+                '_PCI_RESCAN_PATH', '/sys/bus/pci/rescan')
+    def _test_plug_VIP4(self, distro, mock_makedirs,
                         mock_copytree, mock_check_output, mock_netns,
                         mock_netns_create, mock_pyroute2, mock_int_exists,
-                        mock_nspopen, mock_copy2, mock_os_chmod):
-        mock_ipr = mock.MagicMock()
+                        mock_nspopen, mock_copy2, mock_os_chmod,
+                        mock_update_plugged, mock_time):
         mock_ipr_instance = mock.MagicMock()
-        mock_ipr_instance.link_lookup.side_effect = [[], [], [33], [33], [33],
-                                                     [33], [33], [33]]
-        mock_ipr_instance.get_links.return_value = ({
-            'attrs': [('IFLA_IFNAME', FAKE_INTERFACE)]},)
-        mock_ipr.__enter__.return_value = mock_ipr_instance
-        mock_pyroute2.return_value = mock_ipr
-
-        mock_isfile.return_value = True
+        mock_ipr_instance.get_links.return_value = [_fake_link()]
+        mock_pyroute2.return_value = mock_ipr_instance
 
         self.assertIn(distro, [consts.UBUNTU, consts.CENTOS])
         subnet_info = {
@@ -1552,6 +1574,8 @@ class TestServerTestCase(base.TestCase):
         mock_int_exists.return_value = False
 
         # No interface at all
+        mock_ipr_instance.get_links.return_value = []
+        mock_time.return_value = 100
         file_name = '/sys/bus/pci/rescan'
         m = self.useFixture(test_utils.OpenFixture(file_name)).mock_open
         with mock.patch('os.open') as mock_open, mock.patch.object(
@@ -1576,6 +1600,33 @@ class TestServerTestCase(base.TestCase):
                          jsonutils.loads(rv.data.decode('utf-8')))
 
         # Two interfaces down
+        # The PCI bus was rescanned within PCI_RESCAN_INTERVAL, it is not
+        # rescanned again
+        mock_time.return_value = 100 + plug.PCI_RESCAN_INTERVAL - 1
+        m().reset_mock()
+        with mock.patch('os.open') as mock_open, mock.patch.object(
+                os, 'fdopen', m):
+            mock_open.return_value = 123
+
+            if distro == consts.UBUNTU:
+                rv = self.ubuntu_app.post('/' + api_server.VERSION +
+                                          "/plug/vip/203.0.113.2",
+                                          content_type='application/json',
+                                          data=jsonutils.dumps(subnet_info))
+            elif distro == consts.CENTOS:
+                rv = self.centos_app.post('/' + api_server.VERSION +
+                                          "/plug/vip/203.0.113.2",
+                                          content_type='application/json',
+                                          data=jsonutils.dumps(subnet_info))
+            mock_open.assert_not_called()
+        m().write.assert_not_called()
+        self.assertEqual(404, rv.status_code)
+        self.assertEqual(dict(details="No suitable network interface found"),
+                         jsonutils.loads(rv.data.decode('utf-8')))
+
+        # Still no interface, PCI_RESCAN_INTERVAL has elapsed since the last
+        # rescan, the PCI bus is rescanned again
+        mock_time.return_value = 100 + plug.PCI_RESCAN_INTERVAL
         m().reset_mock()
         with mock.patch('os.open') as mock_open, mock.patch.object(
                 os, 'fdopen', m) as mock_fdopen:
@@ -1599,6 +1650,7 @@ class TestServerTestCase(base.TestCase):
                          jsonutils.loads(rv.data.decode('utf-8')))
 
         # Happy Path IPv4, with VRRP_IP and host route
+        mock_ipr_instance.get_links.return_value = [_fake_link()]
         full_subnet_info = {
             'subnet_cidr': '203.0.113.0/24',
             'gateway': '203.0.113.1',
@@ -1644,11 +1696,8 @@ class TestServerTestCase(base.TestCase):
             mock_open.assert_any_call(file_name, flags, mode)
             mock_fdopen.assert_any_call(123, 'w')
 
-            plug_inf_file = '/var/lib/octavia/plugged_interfaces'
-            flags = os.O_RDWR | os.O_CREAT
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            mock_open.assert_any_call(plug_inf_file, flags, mode)
-            mock_fdopen.assert_any_call(123, 'r+')
+            mock_update_plugged.assert_called_with(
+                consts.NETNS_PRIMARY_INTERFACE, '123')
 
             expected_dict = {
                 consts.NAME: consts.NETNS_PRIMARY_INTERFACE,
@@ -1725,17 +1774,12 @@ class TestServerTestCase(base.TestCase):
                  consts.NETNS_PRIMARY_INTERFACE], stderr=-2)
 
         # Verify sysctl was loaded
-        calls = [mock.call('amphora-haproxy', ['/sbin/sysctl', '--system'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy', ['modprobe', 'ip_vs'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy',
-                           ['/sbin/sysctl', '-w', 'net.ipv4.ip_forward=1'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy',
-                           ['/sbin/sysctl', '-w', 'net.ipv4.vs.conntrack=1'],
-                           stdout=subprocess.PIPE)]
-        mock_nspopen.assert_has_calls(calls, any_order=True)
+        mock_nspopen.assert_called_once_with(
+            'amphora-haproxy',
+            ['sh', '-c', '/sbin/sysctl --system; modprobe ip_vs; '
+             '/sbin/sysctl -w net.ipv4.vs.conntrack=1; '
+             '/sbin/sysctl -w net.ipv4.ip_forward=1'],
+            stdout=subprocess.PIPE)
 
         # One Interface down, Happy Path IPv4
         mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
@@ -1770,11 +1814,8 @@ class TestServerTestCase(base.TestCase):
             mock_open.assert_any_call(file_name, flags, mode)
             mock_fdopen.assert_any_call(123, 'w')
 
-            plug_inf_file = '/var/lib/octavia/plugged_interfaces'
-            flags = os.O_RDWR | os.O_CREAT
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            mock_open.assert_any_call(plug_inf_file, flags, mode)
-            mock_fdopen.assert_any_call(123, 'r+')
+            mock_update_plugged.assert_called_with(
+                consts.NETNS_PRIMARY_INTERFACE, '123')
 
             expected_dict = {
                 consts.NAME: consts.NETNS_PRIMARY_INTERFACE,
@@ -1864,6 +1905,9 @@ class TestServerTestCase(base.TestCase):
     def test_centos_plug_VIP6(self):
         self._test_plug_vip6(consts.CENTOS)
 
+    @mock.patch('time.monotonic')
+    @mock.patch('octavia.amphorae.backends.agent.api_server.'
+                'plug.Plug._update_plugged_interfaces_file')
     @mock.patch('os.chmod')
     @mock.patch('shutil.copy2')
     @mock.patch('pyroute2.NSPopen', create=True)
@@ -1873,21 +1917,17 @@ class TestServerTestCase(base.TestCase):
     @mock.patch('subprocess.check_output')
     @mock.patch('shutil.copytree')
     @mock.patch('os.makedirs')
-    @mock.patch('os.path.isfile')
-    def _test_plug_vip6(self, distro, mock_isfile, mock_makedirs,
+    @mock.patch('octavia.amphorae.backends.agent.api_server.plug.'
+                '_PCI_RESCAN_PATH', '/sys/bus/pci/rescan')
+    def _test_plug_vip6(self, distro, mock_makedirs,
                         mock_copytree, mock_check_output, mock_netns,
                         mock_netns_create, mock_pyroute2, mock_nspopen,
-                        mock_copy2, mock_os_chmod):
-        mock_ipr = mock.MagicMock()
+                        mock_copy2, mock_os_chmod, mock_update_plugged,
+                        mock_time):
         mock_ipr_instance = mock.MagicMock()
-        mock_ipr_instance.link_lookup.side_effect = [[], [], [33], [33], [33],
-                                                     [33], [33], [33]]
-        mock_ipr_instance.get_links.return_value = ({
-            'attrs': [('IFLA_IFNAME', FAKE_INTERFACE)]},)
-        mock_ipr.__enter__.return_value = mock_ipr_instance
-        mock_pyroute2.return_value = mock_ipr
-
-        mock_isfile.return_value = True
+        mock_ipr_instance.get_links.return_value = [_fake_link()]
+        mock_pyroute2.return_value = mock_ipr_instance
+        mock_netns.return_value.link_lookup.return_value = []
 
         self.assertIn(distro, [consts.UBUNTU, consts.CENTOS])
         subnet_info = {
@@ -1925,6 +1965,8 @@ class TestServerTestCase(base.TestCase):
         self.assertEqual(400, rv.status_code)
 
         # No interface at all
+        mock_ipr_instance.get_links.return_value = []
+        mock_time.return_value = 100
         file_name = '/sys/bus/pci/rescan'
         m = self.useFixture(test_utils.OpenFixture(file_name)).mock_open
         with mock.patch('os.open') as mock_open, mock.patch.object(
@@ -1948,6 +1990,32 @@ class TestServerTestCase(base.TestCase):
                          jsonutils.loads(rv.data.decode('utf-8')))
 
         # Two interfaces down
+        # The PCI bus was rescanned within PCI_RESCAN_INTERVAL, it is not
+        # rescanned again
+        mock_time.return_value = 100 + plug.PCI_RESCAN_INTERVAL - 1
+        m().reset_mock()
+        with mock.patch('os.open') as mock_open, mock.patch.object(
+                os, 'fdopen', m):
+            mock_open.return_value = 123
+            if distro == consts.UBUNTU:
+                rv = self.ubuntu_app.post('/' + api_server.VERSION +
+                                          "/plug/vip/2001:db8::2",
+                                          content_type='application/json',
+                                          data=jsonutils.dumps(subnet_info))
+            elif distro == consts.CENTOS:
+                rv = self.centos_app.post('/' + api_server.VERSION +
+                                          "/plug/vip/2001:db8::2",
+                                          content_type='application/json',
+                                          data=jsonutils.dumps(subnet_info))
+            mock_open.assert_not_called()
+        m().write.assert_not_called()
+        self.assertEqual(404, rv.status_code)
+        self.assertEqual(dict(details="No suitable network interface found"),
+                         jsonutils.loads(rv.data.decode('utf-8')))
+
+        # Still no interface, PCI_RESCAN_INTERVAL has elapsed since the last
+        # rescan, the PCI bus is rescanned again
+        mock_time.return_value = 100 + plug.PCI_RESCAN_INTERVAL
         m().reset_mock()
         with mock.patch('os.open') as mock_open, mock.patch.object(
                 os, 'fdopen', m) as mock_fdopen:
@@ -1970,6 +2038,7 @@ class TestServerTestCase(base.TestCase):
                          jsonutils.loads(rv.data.decode('utf-8')))
 
         # Happy Path IPv6, with VRRP_IP and host route
+        mock_ipr_instance.get_links.return_value = [_fake_link()]
         full_subnet_info = {
             'subnet_cidr': '2001:db8::/32',
             'gateway': '2001:db8::1',
@@ -2010,11 +2079,8 @@ class TestServerTestCase(base.TestCase):
             mock_open.assert_any_call(file_name, flags, mode)
             mock_fdopen.assert_any_call(123, 'w')
 
-            plug_inf_file = '/var/lib/octavia/plugged_interfaces'
-            flags = os.O_RDWR | os.O_CREAT
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            mock_open.assert_any_call(plug_inf_file, flags, mode)
-            mock_fdopen.assert_any_call(123, 'r+')
+            mock_update_plugged.assert_called_with(
+                consts.NETNS_PRIMARY_INTERFACE, '123')
             expected_dict = {
                 consts.NAME: consts.NETNS_PRIMARY_INTERFACE,
                 consts.MTU: 1450,
@@ -2090,18 +2156,12 @@ class TestServerTestCase(base.TestCase):
                         netns_int=consts.NETNS_PRIMARY_INTERFACE)], stderr=-2)
 
         # Verify sysctl was loaded
-        calls = [mock.call('amphora-haproxy', ['/sbin/sysctl', '--system'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy', ['modprobe', 'ip_vs'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy',
-                           ['/sbin/sysctl', '-w',
-                            'net.ipv6.conf.all.forwarding=1'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy',
-                           ['/sbin/sysctl', '-w', 'net.ipv4.vs.conntrack=1'],
-                           stdout=subprocess.PIPE)]
-        mock_nspopen.assert_has_calls(calls, any_order=True)
+        mock_nspopen.assert_called_once_with(
+            'amphora-haproxy',
+            ['sh', '-c', '/sbin/sysctl --system; modprobe ip_vs; '
+             '/sbin/sysctl -w net.ipv4.vs.conntrack=1; '
+             '/sbin/sysctl -w net.ipv6.conf.all.forwarding=1'],
+            stdout=subprocess.PIPE)
 
         # One Interface down, Happy Path IPv6
         flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
@@ -2130,11 +2190,8 @@ class TestServerTestCase(base.TestCase):
             mock_open.assert_any_call(file_name, flags, mode)
             mock_fdopen.assert_any_call(123, 'w')
 
-            plug_inf_file = '/var/lib/octavia/plugged_interfaces'
-            flags = os.O_RDWR | os.O_CREAT
-            mode = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            mock_open.assert_any_call(plug_inf_file, flags, mode)
-            mock_fdopen.assert_any_call(123, 'r+')
+            mock_update_plugged.assert_called_with(
+                consts.NETNS_PRIMARY_INTERFACE, '123')
 
             expected_dict = {
                 consts.NAME: consts.NETNS_PRIMARY_INTERFACE,
@@ -12,9 +12,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 import os
+import socket
 import subprocess
+import threading
 from unittest import mock
 
+import fixtures
 from oslo_config import cfg
 from oslo_config import fixture as oslo_fixture
 from werkzeug import exceptions as wz_exceptions
@@ -35,6 +38,14 @@ FAKE_MAC_ADDRESS = 'ab:cd:ef:00:ff:22'
 FAKE_INTERFACE = 'eth33'
 
 
+def _fake_link(index=33, ifname=FAKE_INTERFACE, address=FAKE_MAC_ADDRESS):
+    link = mock.MagicMock()
+    link.__getitem__.side_effect = {'index': index}.__getitem__
+    link.get_attr.side_effect = {
+        'IFLA_IFNAME': ifname, 'IFLA_ADDRESS': address}.get
+    return link
+
+
 class TestPlug(base.TestCase):
     def setUp(self):
         super().setUp()
@@ -45,53 +56,115 @@ class TestPlug(base.TestCase):
         self.addCleanup(self.mock_platform.stop)
 
     @mock.patch('pyroute2.IPRoute', create=True)
-    def test__interface_by_mac_case_insensitive_ubuntu(self, mock_ipr):
+    def test__link_by_mac_ubuntu(self, mock_ipr):
         mock_ipr_instance = mock.MagicMock()
-        mock_ipr_instance.link_lookup.return_value = [33]
-        mock_ipr_instance.get_links.return_value = ({
-            'attrs': [('IFLA_IFNAME', FAKE_INTERFACE)]},)
-        mock_ipr().__enter__.return_value = mock_ipr_instance
+        mock_ipr_instance.get_links.return_value = [
+            _fake_link(index=1, ifname='lo', address='00:00:00:00:00:00'),
+            _fake_link()]
+        mock_ipr.return_value = mock_ipr_instance
 
-        interface = self.test_plug._interface_by_mac(FAKE_MAC_ADDRESS.upper())
-        self.assertEqual(FAKE_INTERFACE, interface)
-        mock_ipr_instance.get_links.assert_called_once_with(33)
+        link = self.test_plug._link_by_mac(FAKE_MAC_ADDRESS)
+        self.assertEqual((33, FAKE_INTERFACE), link)
+        mock_ipr_instance.get_links.assert_called_once_with()
+        mock_ipr_instance.link_lookup.assert_not_called()
 
+    @mock.patch('octavia.amphorae.backends.agent.api_server.plug.Plug.'
+                '_netns_interface_exists', return_value=False)
     @mock.patch('pyroute2.IPRoute', create=True)
-    def test__interface_by_mac_not_found(self, mock_ipr):
+    def test__link_by_mac_not_found(self, mock_ipr, mock_int_exists):
         mock_ipr_instance = mock.MagicMock()
-        mock_ipr_instance.link_lookup.return_value = []
-        mock_ipr().__enter__.return_value = mock_ipr_instance
+        mock_ipr_instance.get_links.return_value = [
+            _fake_link(address='00:00:00:00:00:00')]
+        mock_ipr.return_value = mock_ipr_instance
 
         fd_mock = mock.mock_open()
         open_mock = mock.Mock()
-        isfile_mock = mock.Mock()
         with mock.patch('os.open', open_mock), mock.patch.object(
                 os, 'fdopen', fd_mock), mock.patch.object(
-                os.path, 'isfile', isfile_mock):
+                plug, '_PCI_RESCAN_PATH', '/sys/bus/pci/rescan'):
             self.assertRaises(wz_exceptions.HTTPException,
-                              self.test_plug._interface_by_mac,
-                              FAKE_MAC_ADDRESS.upper())
+                              self.test_plug._link_by_mac,
+                              FAKE_MAC_ADDRESS)
         open_mock.assert_called_once_with('/sys/bus/pci/rescan', os.O_WRONLY)
         fd_mock().write.assert_called_once_with('1')
+        mock_int_exists.assert_called_once_with(FAKE_MAC_ADDRESS)
 
+    @mock.patch('octavia.amphorae.backends.agent.api_server.plug.Plug.'
+                '_netns_interface_exists', return_value=True)
     @mock.patch('pyroute2.IPRoute', create=True)
-    def test__interface_by_mac_case_insensitive_rh(self, mock_ipr):
+    def test__link_by_mac_already_in_namespace(self, mock_ipr,
+                                               mock_int_exists):
+        mock_ipr.return_value.get_links.return_value = []
+
+        open_mock = mock.Mock()
+        with mock.patch('os.open', open_mock), mock.patch.object(
+                plug, '_PCI_RESCAN_PATH', '/sys/bus/pci/rescan'):
+            exc = self.assertRaises(wz_exceptions.HTTPException,
+                                    self.test_plug._link_by_mac,
+                                    FAKE_MAC_ADDRESS)
+        self.assertEqual(409, exc.response.status_code)
+        open_mock.assert_not_called()
+
+    @mock.patch('octavia.amphorae.backends.agent.api_server.plug.Plug.'
+                '_netns_interface_exists', return_value=False)
+    @mock.patch('pyroute2.IPRoute', create=True)
+    def test__link_by_mac_not_found_no_rescan_file(self, mock_ipr,
+                                                   mock_int_exists):
         mock_ipr_instance = mock.MagicMock()
-        mock_ipr_instance.link_lookup.return_value = [33]
-        mock_ipr_instance.get_links.return_value = ({
-            'attrs': [('IFLA_IFNAME', FAKE_INTERFACE)]},)
-        mock_ipr().__enter__.return_value = mock_ipr_instance
+        mock_ipr_instance.get_links.return_value = [
+            _fake_link(address='00:00:00:00:00:00')]
+        mock_ipr.return_value = mock_ipr_instance
+
+        open_mock = mock.Mock()
+        with mock.patch('os.open', open_mock), mock.patch.object(
+                plug, '_PCI_RESCAN_PATH', None):
+            self.assertRaises(wz_exceptions.HTTPException,
+                              self.test_plug._link_by_mac,
+                              FAKE_MAC_ADDRESS)
+        open_mock.assert_not_called()
+
+    @mock.patch('octavia.amphorae.backends.agent.api_server.plug.Plug.'
+                '_netns_interface_exists', return_value=False)
+    @mock.patch('time.monotonic')
+    @mock.patch('pyroute2.IPRoute', create=True)
+    def test__link_by_mac_not_found_rescan_rate_limited(self, mock_ipr,
+                                                        mock_time,
+                                                        mock_int_exists):
+        mock_ipr_instance = mock.MagicMock()
+        mock_ipr_instance.get_links.return_value = [
+            _fake_link(address='00:00:00:00:00:00')]
+        mock_ipr.return_value = mock_ipr_instance
+
+        open_mock = mock.Mock()
+        with mock.patch('os.open', open_mock), mock.patch.object(
+                os, 'fdopen', mock.mock_open()), mock.patch.object(
+                plug, '_PCI_RESCAN_PATH', '/sys/bus/pci/rescan'):
+            for now in (100, 101, 100 + plug.PCI_RESCAN_INTERVAL):
+                mock_time.return_value = now
+                self.assertRaises(wz_exceptions.HTTPException,
+                                  self.test_plug._link_by_mac,
+                                  FAKE_MAC_ADDRESS)
+
+        # The second lookup is within the rescan interval of the first one
+        self.assertEqual(2, open_mock.call_count)
+
+    @mock.patch('pyroute2.IPRoute', create=True)
+    def test__link_by_mac_rh(self, mock_ipr):
+        mock_ipr_instance = mock.MagicMock()
+        mock_ipr_instance.get_links.return_value = [
+            _fake_link(index=1, ifname='lo', address='00:00:00:00:00:00'),
+            _fake_link()]
+        mock_ipr.return_value = mock_ipr_instance
 
         with mock.patch('distro.id', return_value='centos'):
             osutil = osutils.BaseOS.get_os_util()
             self.test_plug = plug.Plug(osutil)
-            interface = self.test_plug._interface_by_mac(
-                FAKE_MAC_ADDRESS.upper())
-            self.assertEqual(FAKE_INTERFACE, interface)
-            mock_ipr_instance.get_links.assert_called_once_with(33)
+            link = self.test_plug._link_by_mac(FAKE_MAC_ADDRESS)
+            self.assertEqual((33, FAKE_INTERFACE), link)
+            mock_ipr_instance.get_links.assert_called_once_with()
 
     @mock.patch('octavia.amphorae.backends.agent.api_server.plug.Plug.'
-                '_interface_by_mac', return_value=FAKE_INTERFACE)
+                '_update_plugged_interfaces_file')
     @mock.patch('pyroute2.NSPopen', create=True)
     @mock.patch.object(plug, "webob")
     @mock.patch('pyroute2.IPRoute', create=True)
@@ -103,7 +176,9 @@ class TestPlug(base.TestCase):
     def test_plug_vip_ipv4(self, mock_makedirs, mock_copytree,
                            mock_check_output, mock_netns, mock_netns_create,
                            mock_pyroute2, mock_webob, mock_nspopen,
-                           mock_by_mac):
+                           mock_update_plugged):
+        mock_netns.return_value.link_lookup.return_value = []
+        mock_pyroute2.return_value.get_links.return_value = [_fake_link()]
         m = mock.mock_open()
         with mock.patch('os.open'), mock.patch.object(os, 'fdopen', m):
             self.test_plug.plug_vip(
@@ -117,20 +192,20 @@ class TestPlug(base.TestCase):
             'details': 'VIP {vip} plugged on interface {interface}'.format(
                 vip=FAKE_IP_IPV4, interface='eth1')
         }, status=202)
-        calls = [mock.call('amphora-haproxy', ['/sbin/sysctl', '--system'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy', ['modprobe', 'ip_vs'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy',
-                           ['/sbin/sysctl', '-w', 'net.ipv4.ip_forward=1'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy',
-                           ['/sbin/sysctl', '-w', 'net.ipv4.vs.conntrack=1'],
-                           stdout=subprocess.PIPE)]
-        mock_nspopen.assert_has_calls(calls, any_order=True)
+        mock_nspopen.assert_called_once_with(
+            'amphora-haproxy',
+            ['sh', '-c', '/sbin/sysctl --system; modprobe ip_vs; '
+             '/sbin/sysctl -w net.ipv4.vs.conntrack=1; '
+             '/sbin/sysctl -w net.ipv4.ip_forward=1'],
+            stdout=subprocess.PIPE)
+        mock_update_plugged.assert_called_once_with(
+            constants.NETNS_PRIMARY_INTERFACE, FAKE_MAC_ADDRESS)
+        mock_pyroute2.return_value.link.assert_called_once_with(
+            'set', index=33, net_ns_fd=constants.AMPHORA_NAMESPACE,
+            IFLA_IFNAME=constants.NETNS_PRIMARY_INTERFACE)
 
     @mock.patch('octavia.amphorae.backends.agent.api_server.plug.Plug.'
-                '_interface_by_mac', return_value=FAKE_INTERFACE)
+                '_update_plugged_interfaces_file')
     @mock.patch('pyroute2.NSPopen', create=True)
     @mock.patch.object(plug, "webob")
     @mock.patch('pyroute2.IPRoute', create=True)
@@ -142,7 +217,9 @@ class TestPlug(base.TestCase):
     def test_plug_vip_ipv6(self, mock_makedirs, mock_copytree,
                            mock_check_output, mock_netns, mock_netns_create,
                            mock_pyroute2, mock_webob, mock_nspopen,
-                           mock_by_mac):
+                           mock_update_plugged):
+        mock_netns.return_value.link_lookup.return_value = []
+        mock_pyroute2.return_value.get_links.return_value = [_fake_link()]
         conf = self.useFixture(oslo_fixture.Config(cfg.CONF))
         conf.config(group='controller_worker',
                     loadbalancer_topology=constants.TOPOLOGY_ACTIVE_STANDBY)
@@ -159,18 +236,143 @@ class TestPlug(base.TestCase):
             'details': 'VIP {vip} plugged on interface {interface}'.format(
                 vip=FAKE_IP_IPV6_EXPANDED, interface='eth1')
         }, status=202)
-        calls = [mock.call('amphora-haproxy', ['/sbin/sysctl', '--system'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy', ['modprobe', 'ip_vs'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy',
-                           ['/sbin/sysctl', '-w',
-                            'net.ipv6.conf.all.forwarding=1'],
-                           stdout=subprocess.PIPE),
-                 mock.call('amphora-haproxy',
-                           ['/sbin/sysctl', '-w', 'net.ipv4.vs.conntrack=1'],
-                           stdout=subprocess.PIPE)]
-        mock_nspopen.assert_has_calls(calls, any_order=True)
+        mock_nspopen.assert_called_once_with(
+            'amphora-haproxy',
+            ['sh', '-c', '/sbin/sysctl --system; modprobe ip_vs; '
+             '/sbin/sysctl -w net.ipv4.vs.conntrack=1; '
+             '/sbin/sysctl -w net.ipv6.conf.all.forwarding=1'],
+            stdout=subprocess.PIPE)
+        mock_update_plugged.assert_called_once_with(
+            constants.NETNS_PRIMARY_INTERFACE, FAKE_MAC_ADDRESS)
+        mock_pyroute2.return_value.link.assert_called_once_with(
+            'set', index=33, net_ns_fd=constants.AMPHORA_NAMESPACE,
+            IFLA_IFNAME=constants.NETNS_PRIMARY_INTERFACE)
+
+    @mock.patch('pyroute2.NSPopen', create=True)
+    @mock.patch('pyroute2.IPRoute', create=True)
+    @mock.patch('pyroute2.netns.create', create=True)
+    @mock.patch('pyroute2.NetNS', create=True)
+    def test_plug_vip_write_failure_releases_nspopen(self, mock_netns,
+                                                     mock_netns_create,
+                                                     mock_pyroute2,
+                                                     mock_nspopen):
+        mock_netns.return_value.link_lookup.return_value = []
+        mock_pyroute2.return_value.get_links.return_value = [_fake_link()]
+        mock_write = mock.Mock(side_effect=OSError('boom'))
+        with mock.patch.object(self.osutil, 'write_vip_interface_file',
+                               mock_write):
+            self.assertRaises(OSError, self.test_plug.plug_vip,
+                              vip=FAKE_IP_IPV4,
+                              subnet_cidr=FAKE_CIDR_IPV4,
+                              gateway=FAKE_GATEWAY_IPV4,
+                              mac_address=FAKE_MAC_ADDRESS)
+
+        mock_nspopen.return_value.wait.assert_called_once_with()
+        mock_nspopen.return_value.release.assert_called_once_with()
+        mock_pyroute2.return_value.link.assert_not_called()
+
+    @mock.patch('octavia.amphorae.backends.agent.api_server.plug.Plug.'
+                '_interface_not_found',
+                side_effect=wz_exceptions.HTTPException('not found'))
+    @mock.patch('pyroute2.NSPopen', create=True)
+    @mock.patch('pyroute2.IPRoute', create=True)
+    @mock.patch('pyroute2.netns.create', create=True)
+    @mock.patch('pyroute2.NetNS', create=True)
+    def test_plug_vip_interface_not_found(self, mock_netns, mock_netns_create,
+                                          mock_pyroute2, mock_nspopen,
+                                          mock_not_found):
+        mock_netns.return_value.link_lookup.return_value = []
+        mock_pyroute2.return_value.get_links.return_value = []
+
+        self.assertRaises(wz_exceptions.HTTPException, self.test_plug.plug_vip,
+                          vip=FAKE_IP_IPV4,
+                          subnet_cidr=FAKE_CIDR_IPV4,
+                          gateway=FAKE_GATEWAY_IPV4,
+                          mac_address=FAKE_MAC_ADDRESS)
+
+        mock_not_found.assert_called_once_with()
+        mock_nspopen.assert_not_called()
+        mock_pyroute2.return_value.link.assert_not_called()
+
+    @mock.patch.object(plug, "webob")
+    @mock.patch('pyroute2.IPRoute', create=True)
+    @mock.patch('pyroute2.netns.create', create=True)
+    @mock.patch('pyroute2.NetNS', create=True)
+    def test_plug_network_upper_case_mac_exists(self, mock_netns,
+                                                mock_netns_create,
+                                                mock_pyroute2, mock_webob):
+        # Another plug moved the interface after it was looked up
+        mock_pyroute2.return_value.get_links.return_value = [_fake_link()]
+        mock_netns.return_value.get_links.return_value = [_fake_link()]
+
+        self.test_plug.plug_network(FAKE_MAC_ADDRESS.upper(), [])
+
+        mock_webob.Response.assert_called_once_with(
+            body=b'{"message": "Interface already exists"}',
+            content_type='application/json', status=409)
+        mock_pyroute2.return_value.link.assert_not_called()
+
+    @mock.patch.object(plug, "webob")
+    @mock.patch('pyroute2.IPRoute', create=True)
+    @mock.patch('pyroute2.netns.create', create=True)
+    @mock.patch('pyroute2.NetNS', create=True)
+    def test_plug_vip_upper_case_mac_exists(self, mock_netns,
+                                            mock_netns_create, mock_pyroute2,
+                                            mock_webob):
+        # Another plug moved the interface after it was looked up
+        mock_pyroute2.return_value.get_links.return_value = [_fake_link()]
+        mock_netns.return_value.link_lookup.return_value = [33]
+
+        self.test_plug.plug_vip(
+            vip=FAKE_IP_IPV4,
+            subnet_cidr=FAKE_CIDR_IPV4,
+            gateway=FAKE_GATEWAY_IPV4,
+            mac_address=FAKE_MAC_ADDRESS.upper())
+
+        mock_netns.return_value.link_lookup.assert_called_once_with(
+            address=FAKE_MAC_ADDRESS)
+        mock_webob.Response.assert_called_once_with(
+            body=b'{"message": "Interface already exists"}',
+            content_type='application/json', status=409)
+        mock_pyroute2.return_value.link.assert_not_called()
+
+    @mock.patch.object(plug, "webob")
+    @mock.patch('pyroute2.IPRoute', create=True)
+    def test_plug_vip_null_ip(self, mock_pyroute2, mock_webob):
+        self.test_plug.plug_vip(
+            vip=None,
+            subnet_cidr=FAKE_CIDR_IPV4,
+            gateway=FAKE_GATEWAY_IPV4,
+            mac_address=FAKE_MAC_ADDRESS)
+
+        mock_webob.Response.assert_called_once_with(
+            body=b'{"message": "Invalid VIP"}',
+            content_type='application/json', status=400)
+        mock_pyroute2.assert_not_called()
+
+    @mock.patch.object(plug, "webob")
+    @mock.patch('pyroute2.IPRoute', create=True)
+    def test_plug_vip_bad_mac(self, mock_pyroute2, mock_webob):
+        self.test_plug.plug_vip(
+            vip=FAKE_IP_IPV4,
+            subnet_cidr=FAKE_CIDR_IPV4,
+            gateway=FAKE_GATEWAY_IPV4,
+            mac_address=None)
+
+        mock_webob.Response.assert_called_once_with(
+            body=b'{"message": "Invalid VIP"}',
+            content_type='application/json', status=400)
+        mock_pyroute2.assert_not_called()
+
+    @mock.patch.object(plug, "webob")
+    @mock.patch('pyroute2.IPRoute', create=True)
+    def test_plug_network_bad_mac(self, mock_pyroute2, mock_webob):
+        self.test_plug.plug_network(None, [])
+
+        mock_webob.Response.assert_called_once_with(
+            body=b'{"message": "Invalid network port"}',
+            content_type='application/json', status=400)
+        mock_pyroute2.assert_not_called()
 
     @mock.patch.object(plug, "webob")
     @mock.patch('pyroute2.IPRoute', create=True)
@@ -190,19 +392,245 @@ class TestPlug(base.TestCase):
                 gateway=FAKE_GATEWAY_IPV4,
                 mac_address=FAKE_MAC_ADDRESS
             )
-        mock_webob.Response.assert_any_call(json={'message': 'Invalid VIP'},
-                                            status=400)
+        mock_webob.Response.assert_called_once_with(
+            body=b'{"message": "Invalid VIP"}',
+            content_type='application/json', status=400)
+
+    def test__subnet_prefixlen(self):
+        self.assertEqual(24, plug._subnet_prefixlen(FAKE_CIDR_IPV4))
+        self.assertEqual(32, plug._subnet_prefixlen(FAKE_CIDR_IPV6))
+        self.assertEqual(32, plug._subnet_prefixlen('10.0.0.1'))
+        self.assertEqual(128, plug._subnet_prefixlen('2001:db8::1'))
+        self.assertEqual(0, plug._subnet_prefixlen('0.0.0.0/0'))
+        for subnet_cidr in ('10.0.0.0/33', '2001:db8::/129', '10.0.0.0/',
+                            '10.0.0.0/+24', '10.0.0.1/24', None, 24):
+            self.assertRaises(ValueError, plug._subnet_prefixlen,
+                              subnet_cidr)
+        self.assertRaises(socket.error, plug._subnet_prefixlen, 'error/24')
+
+    def test__update_plugged_interfaces_file(self):
+        plug_inf_file = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'plugged_interfaces')
+        self.useFixture(fixtures.MockPatchObject(
+            constants, 'PLUGGED_INTERFACES', plug_inf_file))
+
+        self.test_plug._update_plugged_interfaces_file('eth1',
+                                                       FAKE_MAC_ADDRESS)
+        # Duplicates are not added
+        self.test_plug._update_plugged_interfaces_file('eth2',
+                                                       FAKE_MAC_ADDRESS)
+        # A MAC address that is a prefix of an existing one is added
+        self.test_plug._update_plugged_interfaces_file(
+            'eth3', FAKE_MAC_ADDRESS[:-1])
+
+        with open(plug_inf_file) as f:
+            self.assertEqual(
+                '{mac} eth1\n{short_mac} eth3\n'.format(
+                    mac=FAKE_MAC_ADDRESS, short_mac=FAKE_MAC_ADDRESS[:-1]),
+                f.read())
+
+    def test__update_plugged_interfaces_file_concurrent(self):
+        plug_inf_file = os.path.join(
+            self.useFixture(fixtures.TempDir()).path, 'plugged_interfaces')
+        self.useFixture(fixtures.MockPatchObject(
+            constants, 'PLUGGED_INTERFACES', plug_inf_file))
+
+        # Block the first caller while it reads the file
+        entered = threading.Event()
+        release = threading.Event()
+        real_read = os.read
+
+        def blocking_read(fd, length):
+            if not entered.is_set():
+                entered.set()
+                release.wait(10)
+            return real_read(fd, length)
+
+        mock_read = self.useFixture(fixtures.MockPatch(
+            'os.read', side_effect=blocking_read)).mock
+
+        threads = [
+            threading.Thread(
+                target=self.test_plug._update_plugged_interfaces_file,
+                args=(interface, FAKE_MAC_ADDRESS))
+            for interface in ('eth1', 'eth2')]
+        threads[0].start()
+        self.assertTrue(entered.wait(10))
+        threads[1].start()
+        threads[1].join(0.1)
+
+        # The second caller waits for the first one to update the file
+        self.assertTrue(threads[1].is_alive())
+        self.assertEqual(1, mock_read.call_count)
+
+        release.set()
+        for thread in threads:
+            thread.join(10)
+
+        with open(plug_inf_file) as f:
+            self.assertEqual('{mac} eth1\n'.format(mac=FAKE_MAC_ADDRESS),
+                             f.read())
+
+    def test_plug_network_concurrent(self):
+        moved = []
+        entered = threading.Event()
+        release = threading.Event()
+
+        # Block the first caller after it counted the links in the
+        # namespace
+        def netns_link_info(mac_address):
+            if not entered.is_set():
+                entered.set()
+                release.wait(10)
+            # lo and the VIP interface, plus the plugged interfaces
+            return False, 2 + len(moved)
+
+        def move_link(*args, **kwargs):
+            moved.append(kwargs['IFLA_IFNAME'])
+
+        mock_ipr = mock.Mock()
+        mock_ipr.link.side_effect = move_link
+        mock_link_info = self.useFixture(fixtures.MockPatchObject(
+            self.test_plug, '_netns_link_info',
+            side_effect=netns_link_info)).mock
+        self.useFixture(fixtures.MockPatchObject(
+            self.test_plug, '_get_ipr', return_value=mock_ipr))
+        self.useFixture(fixtures.MockPatchObject(
+            self.test_plug, '_check_ip_addresses'))
+        self.useFixture(fixtures.MockPatchObject(
+            self.test_plug, '_link_by_mac',
+            return_value=(33, FAKE_INTERFACE)))
+        mock_update_plugged = self.useFixture(fixtures.MockPatchObject(
+            self.test_plug, '_update_plugged_interfaces_file')).mock
+        for method in ('write_port_interface_file', '_bring_if_down',
+                       '_bring_if_up'):
+            self.useFixture(fixtures.MockPatchObject(self.osutil, method))
+
+        threads = [
+            threading.Thread(target=self.test_plug.plug_network,
+                             args=(mac_address, []))
+            for mac_address in ('123', '321')]
+        threads[0].start()
+        self.assertTrue(entered.wait(10))
+        threads[1].start()
+        threads[1].join(0.1)
+
+        # The second plug waits until the first interface is moved into
+        # the namespace
+        self.assertTrue(threads[1].is_alive())
+        self.assertEqual(1, mock_link_info.call_count)
+
+        release.set()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(['eth2', 'eth3'], moved)
+        mock_update_plugged.assert_has_calls([
+            mock.call('eth2', '123'), mock.call('eth3', '321')])
+
+    def test_plug_network_rescan_outside_lock(self):
+        lock_free = []
+
+        def interface_not_found():
+            # The lock is free if another thread can take it
+            def try_lock():
+                if self.test_plug._netns_lock.acquire(blocking=False):
+                    lock_free.append(True)
+                    self.test_plug._netns_lock.release()
 
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join(10)
+            raise wz_exceptions.HTTPException()
+
+        mock_ipr = mock.Mock()
+        mock_ipr.get_links.return_value = []
+        self.useFixture(fixtures.MockPatchObject(
+            self.test_plug, '_get_ipr', return_value=mock_ipr))
+        self.useFixture(fixtures.MockPatchObject(
+            self.test_plug, '_netns_interface_exists', return_value=False))
+        self.useFixture(fixtures.MockPatchObject(
+            self.test_plug, '_interface_not_found',
+            side_effect=interface_not_found))
+
+        self.assertRaises(wz_exceptions.HTTPException,
+                          self.test_plug.plug_network, FAKE_MAC_ADDRESS, [])
+
+        # The PCI bus is rescanned without holding up other plugs
+        self.assertEqual([True], lock_free)
+
+    @mock.patch('pyroute2.netns.create', create=True)
     @mock.patch('pyroute2.NetNS', create=True)
-    def test__netns_interface_exists(self, mock_netns):
+    def test__netns_interface_exists(self, mock_netns, mock_netns_create):
 
-        netns_handle = mock_netns.return_value.__enter__.return_value
+        netns_handle = mock_netns.return_value
 
-        netns_handle.get_links.return_value = [{
-            'attrs': [['IFLA_ADDRESS', '123']]}]
+        netns_handle.link_lookup.side_effect = [[33], []]
 
         # Interface is found in netns
         self.assertTrue(self.test_plug._netns_interface_exists('123'))
 
         # Interface is not found in netns
         self.assertFalse(self.test_plug._netns_interface_exists('321'))
+
+        netns_handle.link_lookup.assert_has_calls([
+            mock.call(address='123'), mock.call(address='321')])
+        netns_handle.get_links.assert_not_called()
+
+    @mock.patch('pyroute2.netns.create', create=True)
+    @mock.patch('pyroute2.NetNS', create=True)
+    def test__netns_link_info(self, mock_netns, mock_netns_create):
+        netns_handle = mock_netns.return_value
+        mock_lo = mock.MagicMock()
+        mock_lo.get_attr.return_value = '00:00:00:00:00:00'
+        mock_link = mock.MagicMock()
+        mock_link.get_attr.return_value = '123'
+        netns_handle.get_links.return_value = [mock_lo, mock_link]
+
+        # Interface is found in netns
+        self.assertEqual((True, 2),
+                         self.test_plug._netns_link_info('123'))
+
+        # Interface is not found in netns
+        self.assertEqual((False, 2),
+                         self.test_plug._netns_link_info('321'))
+
+    @mock.patch('pyroute2.netns.create', create=True)
+    @mock.patch('pyroute2.NetNS', create=True)
+    @mock.patch('pyroute2.IPRoute', create=True)
+    def test_netlink_handles_are_reused(self, mock_ipr, mock_netns,
+                                        mock_netns_create):
+        self.assertIs(self.test_plug._get_ipr(), self.test_plug._get_ipr())
+        mock_ipr.assert_called_once_with()
+
+        self.assertIs(self.test_plug._get_netns(),
+                      self.test_plug._get_netns())
+        mock_netns_create.assert_called_once_with(constants.AMPHORA_NAMESPACE)
+        mock_netns.assert_called_once_with(constants.AMPHORA_NAMESPACE,
+                                           flags=0)
+
+    @mock.patch('pyroute2.netns.create', create=True)
+    @mock.patch('pyroute2.NetNS', create=True)
+    def test__get_netns_existing_namespace(self, mock_netns,
+                                           mock_netns_create):
+        mock_netns_create.side_effect = FileExistsError
+
+        self.assertIs(mock_netns.return_value, self.test_plug._get_netns())
+        mock_netns.assert_called_once_with(constants.AMPHORA_NAMESPACE,
+                                           flags=0)
+
+    @mock.patch('pyroute2.netns.create', create=True)
+    @mock.patch('pyroute2.NetNS', create=True)
+    @mock.patch('pyroute2.IPRoute', create=True)
+    def test_close(self, mock_ipr, mock_netns, mock_netns_create):
+        self.test_plug._get_ipr()
+        self.test_plug._get_netns()
+
+        self.test_plug.close()
+
+        mock_ipr.return_value.close.assert_called_once_with()
+        mock_netns.return_value.close.assert_called_once_with()
+
+        # New handles are opened if the plug is used after close
+        self.test_plug._get_ipr()
+        self.assertEqual(2, mock_ipr.call_count)
@@ -44,3 +44,7 @@ class TestAmphoraAgentCMD(base.TestCase):
 
         mock_health_proc.start.assert_called_once_with()
         mock_amp_instance.run.assert_called_once()
+
+        # Ensure the netlink handles are released when the worker exits
+        mock_amp.call_args[0][1]['worker_exit'](mock.Mock(), mock.Mock())
+        mock_server_instance.shutdown.assert_called_once_with()